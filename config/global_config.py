@@ -13,6 +13,8 @@ MIN_INPUT_VIDEO_LEN = 5
 DELETE_SMALL_FILES = True
 DEBOUNCE_TIMEOUT = 250 # ms
 DO_FAST_VIDEO_GEN = False
+DO_SINGLE_PASS_GEN = False # cut and join all segments in one ffmpeg call instead of per-segment files
+USE_HW_ENCODER = True # use NVENC / VideoToolbox / QSV for re-encodes when ffmpeg has a working one
 
 # ========  DEV ==========
 LOGGING_LEVEL = DEBUG
\ No newline at end of file
@@ -1,8 +1,10 @@
+import tempfile
 from pathlib import Path
 
 # ========== Directories ===========
 ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 CONFIG_DIR = ROOT_DIR / 'config'
 SRC_DIR = ROOT_DIR / 'src'
+CACHE_DIR = Path(tempfile.gettempdir()) / 'bass_driven_video_gen'
 
 DEFAULT_CONFIG_PATH = CONFIG_DIR / "saved_constants.txt"
\ No newline at end of file
@@ -1,13 +1,283 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
-import scipy.signal
-import scipy.ndimage
-import librosa
-from scipy.signal import butter, sosfiltfilt
+import scipy.fft
+from numba import njit
 from pathlib import Path
+from config.global_config import ENABLE_PLOTTING
+from src.common.constants import CACHE_DIR
+from src.util.util import ffprobe_sample_rate, file_digest, load_audio, plot_onsets
+
+# ========= CONSTANTS =========
+DEFAULT_SR = 44100          # Assumed native sample rate when it can't be probed (Hz)
+MIN_ANALYSIS_SR = 11025     # Lowest sample rate the audio is decimated to before filtering (Hz)
+NYQUIST_MARGIN = 2.5        # Analysis rate must be at least this multiple of LF_MAX_HZ
+N_FFT = 2048                # FFT size of the onset envelope at the native sample rate
+TOP_DB = 80.0               # Dynamic range of the log-power spectrogram used for spectral flux (dB)
+N_MELS = 128                # Mel bands across the native sample rate's spectrum, as librosa's default
+MEL_BREAK_HZ = 1000.0       # Mel scale is linear below this frequency and logarithmic above (Hz)
+PEAK_WAIT_SECONDS = 0.03    # Minimum gap between picked envelope peaks (s)
+RESULT_CACHE_VERSION = 2    # Bump whenever detection output changes for the same inputs
+RESULT_CACHE_MAX_FILES = 64 # Detection results kept on disk (about 1 MB each); least recently used go first
+ENVELOPE_CACHE_SIZE = 8     # Onset envelopes kept in memory, one per (file, band, hop) combination
+AUDIO_CACHE_SIZE = 2        # Decoded signals kept in memory, one per (file, analysis sample rate)
+
+# Debug plots render here so saving the PNG never blocks detection
+_plot_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="onset_plot")
+
+# ========= KERNELS =========
+@njit(cache=True, nogil=True)
+def _reflect_index(i: int, n: int) -> int:
+    """Maps an out-of-range index back into [0, n) the way scipy.ndimage's 'reflect' mode does."""
+    while i < 0 or i >= n:
+        if i < 0:
+            i = -i - 1
+        else:
+            i = 2 * n - i - 1
+    return i
+
+
+@njit(cache=True, nogil=True)
+def _median5(values: np.ndarray) -> np.ndarray:
+    """Size-5 running median, equivalent to scipy.ndimage.median_filter(values, size=5).
+
+    Each window is sorted with the optimal 9 compare-swap network for 5 elements, which
+    compiles to branchless min/max pairs.
+    """
+    n = values.size
+    out = np.empty_like(values)
+    for i in range(n):
+        a = values[_reflect_index(i - 2, n)]
+        b = values[_reflect_index(i - 1, n)]
+        c = values[i]
+        d = values[_reflect_index(i + 1, n)]
+        e = values[_reflect_index(i + 2, n)]
+        a, b = min(a, b), max(a, b)
+        d, e = min(d, e), max(d, e)
+        c, e = min(c, e), max(c, e)
+        c, d = min(c, d), max(c, d)
+        a, d = min(a, d), max(a, d)
+        a, c = min(a, c), max(a, c)
+        b, e = min(b, e), max(b, e)
+        b, d = min(b, d), max(b, d)
+        b, c = min(b, c), max(b, c)
+        out[i] = c
+    return out
+
+
+@njit(cache=True, nogil=True)
+def _cooldown_mask(onsets: np.ndarray, min_spacing: float) -> np.ndarray:
+    """Greedy cooldown over sorted onset times.
+
+    Returns a mask that is True for every onset at least min_spacing after the previously kept one.
+    """
+    keep = np.empty(onsets.size, np.bool_)
+    if onsets.size == 0:
+        return keep
+    keep[0] = True
+    last_time = onsets[0]
+    for i in range(1, onsets.size):
+        if onsets[i] - last_time >= min_spacing:
+            keep[i] = True
+            last_time = onsets[i]
+        else:
+            keep[i] = False
+    return keep
+
+
+@njit(cache=True, nogil=True)
+def _peak_pick(x: np.ndarray, pre_max: int, post_max: int, pre_avg: int, post_avg: int,
+               delta: float, wait: int) -> np.ndarray:
+    """Greedy peak picker with the same rules as librosa.util.peak_pick.
+
+    A frame is a peak when it is the maximum of x[n - pre_max:n + post_max], at least delta above
+    the mean of x[n - pre_avg:n + post_avg], and more than wait frames after the previous peak.
+    """
+    n_frames = x.size
+    peaks = np.empty(n_frames, np.int64)
+    count = 0
+    n = 0
+    while n < n_frames:
+        lo = max(0, n - pre_max)
+        hi = min(n + post_max, n_frames)
+        if x[n] < x[lo:hi].max():
+            n += 1
+            continue
+        lo = max(0, n - pre_avg)
+        hi = min(n + post_avg, n_frames)
+        if x[n] < x[lo:hi].mean() + delta:
+            n += 1
+            continue
+        peaks[count] = n
+        count += 1
+        n += wait + 1
+    return peaks[:count]
+
+
+def _spectral_flux(signal: np.ndarray, sample_rate: int, hop_length: int, n_fft: int,
+                   native_sample_rate: int, pad_frames: int) -> np.ndarray:
+    """Onset strength as positive log-power spectral flux, averaged over mel bands.
+
+    The bands are librosa's, laid out over the native sample rate's spectrum; those that fit under
+    the analysis Nyquist are kept. Frames are centered, and the result is front-padded by pad_frames
+    (at least the one frame of lag) and trimmed back to the number of STFT frames, like
+    librosa.onset.onset_strength.
+    """
+    fft_size = scipy.fft.next_fast_len(n_fft, real=True)
+    padded = np.pad(signal, n_fft // 2)
+    frames = np.lib.stride_tricks.sliding_window_view(padded, n_fft)[::hop_length]
+    window = np.hanning(n_fft + 1)[:-1].astype(signal.dtype)    # periodic Hann, as scipy's get_window("hann")
+    spectrum = scipy.fft.rfft(frames * window, n=fft_size, axis=-1, workers=-1)
+
+    # Power is summed into mel bands before the log, which averages out the per-bin noise that would
+    # otherwise show up as spurious flux peaks at small hop lengths. Bands above the pass band are kept:
+    # the filter's stopband is only a level offset in dB, and a kick's attack is sharpest there.
+    power = spectrum.real ** 2
+    power += spectrum.imag ** 2
+    log_power = power @ _mel_filterbank(sample_rate, fft_size, native_sample_rate).astype(power.dtype)
+
+    # Log power is built up in the frames x bands buffer; the out= steps skip a temporary per operation
+    np.maximum(log_power, 1e-10, out=log_power)
+    np.log10(log_power, out=log_power)
+    log_power *= 10.0
+    np.maximum(log_power, log_power.max() - TOP_DB, out=log_power)
+    rise = np.diff(log_power, axis=0)
+    np.maximum(rise, 0.0, out=rise)
+    flux = rise.mean(axis=1)
+
+    return np.pad(flux, (max(1, pad_frames), 0))[:frames.shape[0]]
+
+
+@lru_cache(maxsize=8)
+def _mel_filterbank(sample_rate: int, fft_size: int, native_sample_rate: int) -> np.ndarray:
+    """Slaney-normalized triangular mel filters as a (bins x bands) matrix, memoized on the STFT layout.
+
+    Same band edges as librosa.filters.mel(sr=native_sample_rate, n_mels=N_MELS), so the bands match the
+    native-rate analysis. Only bands that end below the analysis Nyquist and cover at least one bin are kept.
+    """
+    min_log_mel = MEL_BREAK_HZ / (200.0 / 3)
+    log_step = np.log(6.4) / 27.0
+    max_mel = min_log_mel + np.log(native_sample_rate / 2 / MEL_BREAK_HZ) / log_step
+    mels = np.linspace(0.0, max_mel, N_MELS + 2)
+    edges = np.where(mels < min_log_mel, mels * (200.0 / 3),
+                     MEL_BREAK_HZ * np.exp(log_step * (mels - min_log_mel)))
+    edges = edges[edges <= sample_rate / 2 * (1 + 1e-9)]     # tolerance keeps the top edge when not decimating
+
+    bin_hz = np.arange(fft_size // 2 + 1) * (sample_rate / fft_size)
+    lower, center, upper = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    weights = np.maximum(0.0, np.minimum((bin_hz - lower) / (center - lower), (upper - bin_hz) / (upper - center)))
+    weights *= 2.0 / (upper - lower)
+    return np.ascontiguousarray(weights[weights.any(axis=1)].T)
+
+
+# ========= RESULT CACHE =========
+def _prune_result_cache(cache_dir: Path):
+    """Deletes the least recently used detection results beyond RESULT_CACHE_MAX_FILES.
+
+    Entries left behind by an older RESULT_CACHE_VERSION are never hit again, so they age out here too.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        try:
+            entries.append((entry.stat().st_mtime_ns, entry.path))
+        except OSError:
+            pass
+    entries.sort(reverse=True)
+    for _, path in entries[RESULT_CACHE_MAX_FILES:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# ========= ONSET ENVELOPE =========
+@lru_cache(maxsize=32)
+def _band_pass(bass_min_hz: float, bass_max_hz: float, sample_rate: int) -> np.ndarray:
+    """Designs the bass band-pass filter as float64 second-order sections, memoized on the band."""
+    # scipy.signal pulls in scipy.stats and takes over half a second to import, so it is loaded on first
+    # use (on the detection worker) rather than when the editor starts.
+    from scipy.signal import butter
+    # half_sample_rate is the Nyquist frequency (half the sample rate)
+    half_sample_rate = 0.5 * sample_rate
+    return butter(
+        N=4,
+        Wn=[bass_min_hz / half_sample_rate, bass_max_hz / half_sample_rate],
+        btype="band",
+        output="sos"
+    )
+
+
+@lru_cache(maxsize=AUDIO_CACHE_SIZE)
+def _decoded_audio(audio_path: str, size: int, mtime_ns: int, sample_rate: int) -> np.ndarray:
+    """Decodes the audio at the given sample rate, memoized per file version so a band or hop change
+    in the editor re-filters without decoding the file again. The array is read-only."""
+    audio_signal = load_audio(audio_path, sample_rate)
+    audio_signal.setflags(write=False)
+    return audio_signal
+
+
+@lru_cache(maxsize=ENVELOPE_CACHE_SIZE)
+def _band_onset_envelope(audio_path: str, size: int, mtime_ns: int, bass_min_hz: float, bass_max_hz: float,
+                         hop_length: int) -> tuple[np.ndarray, np.ndarray, float, int]:
+    """Band-passes the audio and computes its onset envelope.
+
+    Only depends on the file version (path, size, mtime) and the band and hop, so it is memoized on
+    those; changing ONSET_DELTA or RANDOM_CLIP_MIN re-runs just the peak picking and cooldown.
+
+    Returns:
+        tuple: (times, onset_envelope, frame_seconds, peak_wait). The arrays are read-only.
+    """
+    # --- Step 3: Load the audio signal ---
+    # HOP_LENGTH is expressed in samples at the file's native rate, so look that up first.
+    # Only content below bass_max_hz matters, so decode straight to the native rate divided by the
+    # largest integer factor that keeps the band well under the new Nyquist. ffmpeg downmixes to
+    # mono and resamples in the same pass. Hop and FFT sizes shrink by the same factor so the
+    # frame timing (seconds per frame) stays the same.
+    native_sample_rate = ffprobe_sample_rate(audio_path) or DEFAULT_SR
+    decimation = max(1, int(native_sample_rate // max(MIN_ANALYSIS_SR, NYQUIST_MARGIN * bass_max_hz)))
+    sample_rate = native_sample_rate // decimation
+    # librosa pads the envelope by one frame of lag plus n_fft // (2 * hop) frames. That offset is taken
+    # at the native rate and rounded to the nearest analysis frame; computing it from the decimated
+    # sizes, which are rounded separately, would lose up to a frame of it.
+    pad_seconds = (1 + N_FFT // (2 * hop_length)) * hop_length / native_sample_rate
+    hop_length = max(1, round(hop_length / decimation))
+    n_fft = max(64, N_FFT // decimation)
+    pad_frames = round(pad_seconds * sample_rate / hop_length)
+    audio_signal = _decoded_audio(audio_path, size, mtime_ns, sample_rate)
+
+    # --- Step 4: Design a band-pass filter to isolate bass ---
+    # Butterworth filter designed with order=4, applied in forward-backward mode for zero phase shift
+    from scipy.signal import sosfiltfilt     # loaded on first use, like butter in _band_pass
+    sos = _band_pass(bass_min_hz, bass_max_hz, sample_rate)
+    # Apply filter to the signal. The design and the filtering stay in float64 (a float32 SOS matrix
+    # shifts the response of these narrow low bands by several percent); only the result is cast
+    # back to the decoded float32 so the STFT after it runs in single precision.
+    filtered_signal = sosfiltfilt(sos, audio_signal).astype(np.float32)
+    # Replace any NaNs or infinite values (can happen in audio processing)
+    # The float32 cast already made a fresh array, so clean it in place
+    np.nan_to_num(filtered_signal, copy=False)
+
+    # --- Step 5: Compute the onset envelope ---
+    # The onset envelope represents energy changes over time, emphasizing percussive events.
+    # It is the spectral flux (rise in log power) of the filtered signal's STFT.
+    onset_envelope = _spectral_flux(filtered_signal, sample_rate, hop_length, n_fft, native_sample_rate, pad_frames)
+    # Median filter smooths the envelope to reduce spurious peaks
+    onset_envelope = _median5(onset_envelope)
+
+    # --- Step 6: Map frames to time ---
+    # Each value in onset_envelope corresponds to a frame index; convert to seconds
+    times = np.arange(len(onset_envelope)) * (hop_length / sample_rate)
+
+    # Callers share these arrays through the cache
+    times.setflags(write=False)
+    onset_envelope.setflags(write=False)
+    return times, onset_envelope, hop_length / sample_rate, int(PEAK_WAIT_SECONDS * sample_rate // hop_length)
+
 
 # ========= BASS DETECTOR =========
 class BassDetector:
-    """Detects onsets (bass hits) from a mono-filtered audio file using librosa."""
+    """Detects onsets (bass hits) from a band-pass filtered mono audio file using spectral flux."""
 
     def __init__(self, mp3_path: Path, plot_path: Path | None = None):
         """Initialize the detector with audio path and optional plot path.
@@ -18,6 +288,7 @@ class BassDetector:
 
         """
         self.mp3_path = mp3_path
+        self.plot_path = plot_path
 
     def detect(self, config: dict[str, float | int]) -> list[float]:
         """Perform band-pass filtering and onset detection on the MP3.
@@ -47,70 +318,69 @@ class BassDetector:
         hop_length = config.get("HOP_LENGTH", 512)          # Number of audio samples per analysis frame
         min_hit_spacing = config.get("RANDOM_CLIP_MIN", 0.25)      # Minimum seconds between consecutive hits
 
-        # --- Step 3: Load the audio signal ---
-        # sr=None ensures we load the audio at its native sample rate to avoid timing drift.
-        # mono=True converts stereo to mono by averaging channels.
-        audio_signal, sample_rate = librosa.load(self.mp3_path, sr=None, mono=True)
-
-        # --- Step 4: Design a band-pass filter to isolate bass ---
-        # half_sample_rate is the Nyquist frequency (half the sample rate)
-        # Butterworth filter designed with order=4, applied in forward-backward mode for zero phase shift
-        half_sample_rate = 0.5 * sample_rate
-        sos = butter(
-            N=4,
-            Wn=[bass_min_hz / half_sample_rate, bass_max_hz / half_sample_rate],
-            btype="band",
-            output="sos"
-        )
-        # Apply filter to the signal
-        filtered_signal = sosfiltfilt(sos, audio_signal)
-        # Replace any NaNs or infinite values (can happen in audio processing)
-        filtered_signal = np.nan_to_num(filtered_signal)
-
-        # --- Step 5: Compute the onset envelope ---
-        # The onset envelope represents energy changes over time, emphasizing percussive events.
-        # We use librosa.onset.onset_strength which analyzes spectral flux (change in frequency content)
-        onset_envelope = librosa.onset.onset_strength(
-            y=filtered_signal,
-            sr=sample_rate,
-            hop_length=hop_length
-        )
-        # Median filter smooths the envelope to reduce spurious peaks
-        onset_envelope = scipy.ndimage.median_filter(onset_envelope, size=5)
-
-        # --- Step 6: Map frames to time ---
-        # Each value in onset_envelope corresponds to a frame index; convert to seconds
-        times = librosa.frames_to_time(
-            np.arange(len(onset_envelope)),
-            sr=sample_rate,
-            hop_length=hop_length
+        # --- Step 2b: Reuse a previous result for the same audio content and parameters ---
+        cache_path = self._result_cache_path(bass_min_hz, bass_max_hz, onset_sensitivity, hop_length, min_hit_spacing)
+        if cache_path.exists():
+            with np.load(cache_path) as cached:
+                kept_onsets, dropped_onsets = cached["hits"], cached["dropped"]
+                times, onset_envelope = cached["times"], cached["onset_envelope"]
+            # Cached arrays are handed out read-only; a caller that needs to edit one makes a copy
+            times.setflags(write=False)
+            onset_envelope.setflags(write=False)
+            # Touch the entry so the eviction sweep sees it as recently used
+            try:
+                os.utime(cache_path)
+            except OSError:
+                pass
+            self._submit_plot(kept_onsets, dropped_onsets, times, onset_envelope)
+            return kept_onsets.tolist(), dropped_onsets.tolist(), times, onset_envelope
+
+        # --- Steps 3-6: Band-pass the audio and compute its onset envelope (memoized) ---
+        stat = os.stat(self.mp3_path)
+        times, onset_envelope, frame_seconds, peak_wait = _band_onset_envelope(
+            str(self.mp3_path), stat.st_size, stat.st_mtime_ns, bass_min_hz, bass_max_hz, hop_length
         )
 
         # --- Step 7: Detect onsets (bass hits) ---
-        # librosa.onset.onset_detect returns the times of significant peaks in the envelope
-        # backtrack=False avoids snapping to an earlier local peak, which could cause drift
-        detected_onsets = librosa.onset.onset_detect(
-            onset_envelope=onset_envelope,
-            sr=sample_rate,
-            hop_length=hop_length,
-            units="time",
-            backtrack=False,
-            pre_max=10, post_max=10,    # Local peak neighborhood to consider for detection
-            pre_avg=20, post_avg=20,    # Local average neighborhood for adaptive thresholding
-            delta=onset_sensitivity
+        # Peaks are picked on the envelope normalized to [0, 1], so ONSET_DELTA is a relative threshold.
+        # No backtracking, since snapping to an earlier local minimum could cause drift.
+        normalized_envelope = onset_envelope - onset_envelope.min(initial=0.0)
+        normalized_envelope /= normalized_envelope.max(initial=0.0) + np.finfo(normalized_envelope.dtype).tiny
+        peak_frames = _peak_pick(
+            normalized_envelope,
+            10, 10,     # Local peak neighborhood to consider for detection (pre_max, post_max)
+            20, 20,     # Local average neighborhood for adaptive thresholding (pre_avg, post_avg)
+            float(onset_sensitivity),
+            peak_wait
         )
+        detected_onsets = peak_frames * frame_seconds
 
         # --- Step 8: Apply cooldown to avoid multiple hits from the same bass event ---
-        hits, dropped = [], []
-        if len(detected_onsets) > 0:
-            hits.append(detected_onsets[0])
-            last_time = detected_onsets[0]
-            for onset_time in detected_onsets[1:]:
-                if onset_time - last_time >= min_hit_spacing:
-                    hits.append(onset_time)
-                    last_time = onset_time
-                else:
-                    dropped.append(onset_time)  # Too close to previous hit; ignored
-
-        # --- Step 9: Return results ---
-        return hits, dropped, times, onset_envelope
+        # Onsets closer than min_hit_spacing to the previously kept hit are dropped.
+        detected_onsets = np.ascontiguousarray(detected_onsets, dtype=np.float64)
+        keep = _cooldown_mask(detected_onsets, float(min_hit_spacing))
+        # The onsets stay float64 arrays for the cache and the plot; only the returned lists are boxed
+        kept_onsets = detected_onsets[keep]
+        dropped_onsets = detected_onsets[~keep]
+
+        # --- Step 9: Cache and return results ---
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(tmp_path, hits=kept_onsets, dropped=dropped_onsets, times=times, onset_envelope=onset_envelope)
+        os.replace(tmp_path, cache_path)
+        _prune_result_cache(cache_path.parent)
+        self._submit_plot(kept_onsets, dropped_onsets, times, onset_envelope)
+        return kept_onsets.tolist(), dropped_onsets.tolist(), times, onset_envelope
+
+    def _submit_plot(self, kept_onsets: np.ndarray, dropped_onsets: np.ndarray, times, onset_envelope):
+        """Queues the debug onset plot on the background plot thread, if a plot path was given.
+
+        The onset arrays are handed over as is; the plot thread only reads them.
+        """
+        if ENABLE_PLOTTING and self.plot_path is not None:
+            _plot_executor.submit(plot_onsets, times, onset_envelope, kept_onsets, dropped_onsets, self.plot_path)
+
+    def _result_cache_path(self, *params) -> Path:
+        """Path of the cached detection result for this audio file's contents and the given parameters."""
+        key = "_".join(str(p) for p in (RESULT_CACHE_VERSION, file_digest(self.mp3_path)[:32], *params))
+        return CACHE_DIR / "bass_hits" / f"{key}.npz"
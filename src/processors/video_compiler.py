@@ -1,26 +1,57 @@
-import random
+import os
 import shutil
 import subprocess
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from pathlib import Path
+import numpy as np
 from src.common.env import logger
 from tqdm import tqdm
 
-from config.global_config import DO_FAST_VIDEO_GEN, MIN_INPUT_VIDEO_LEN, DELETE_SMALL_FILES
-from src.util.util import safe_tmp, ffprobe_duration, ffprobe_stream_info
+from config.global_config import DO_FAST_VIDEO_GEN, DO_SINGLE_PASS_GEN, MIN_INPUT_VIDEO_LEN, DELETE_SMALL_FILES
+from src.util.util import safe_tmp, run_command, ffprobe_duration, ffprobe_stream_info
 from src.util.ffmpeg import (
     FAST_COPY_EXTRACT_CMD,
     FRAME_ACCURATE_EXTRACT_CMD,
     CONCAT_COPY_CMD,
     CONCAT_REENCODE_CMD,
-    ADD_AUDIO_CMD,
-    format_ffmpeg_cmd
+    CONCAT_FILE_ENTRY,
+    CONCAT_LIST_ENTRY,
+    SINGLE_PASS_CMD,
+    SINGLE_PASS_INPUT_ARGS,
+    SINGLE_PASS_SEGMENT_FILTER,
+    SINGLE_PASS_OUTPUT_ARGS,
+    SINGLE_PASS_PART_OUTPUT_ARGS,
+    HW_ENCODER_MAX_SESSIONS,
+    active_hw_encoder,
+    escape_concat_path,
+    format_ffmpeg_cmd,
+    video_encoder_args
 )
 
 # ========= CONSTANTS =========
+PROBE_WORKERS = 16
+SINGLE_PASS_MAX_INPUTS = 64     # clips (each its own input and decoder) per ffmpeg call in single-pass mode
 date_str = datetime.now().strftime("%Y%m%d_%H%M")
 output_filename = f"compiled_{date_str}.mp4"
 
+def _progress_frames(progress: str) -> int:
+    """Returns the final frame count from ffmpeg's -progress output."""
+    frames = 0
+    for line in progress.splitlines():
+        if line.startswith("frame="):
+            frames = int(line[len("frame="):])
+    return frames
+
+def _progress_seconds(progress: str) -> float:
+    """Returns the final output time in seconds from ffmpeg's -progress output."""
+    seconds = 0.0
+    for line in progress.splitlines():
+        key, _, value = line.partition("=")
+        if key == "out_time_us" and value.lstrip("-").isdigit():     # "N/A" before the first frame
+            seconds = int(value) / 1e6
+    return seconds
+
 # ========= VIDEO COMPILER =========
 class VideoCompiler:
     """Handles random segment extraction, concatenation, and final video/audio composition."""
@@ -35,19 +66,33 @@ class VideoCompiler:
         self.output_path = folder / output_filename
         self.segments_dir = folder / "segments"
         self._duration_map: dict[Path, float] = {}
-        self._weights: list[float] = []
+        self._weights: np.ndarray = np.empty(0)
         self._cumulative_error: float = 0.0
+        self._encode_threads: int = 0   # encoder threads per extraction, 0 lets ffmpeg decide
+        # Every random choice comes from this generator, so a RANDOM_SEED in the config reproduces a run
+        self._rng = np.random.default_rng(config.get("RANDOM_SEED"))
 
     def collect_videos(self):
         """Scans the folder for valid video files and caches durations."""
         valid_extensions = {".mov", ".mp4"}
-        candidates: list[Path] = [
-            f for f in self.folder.iterdir()
-            if f.suffix.lower() in valid_extensions
-            and not f.name.lower().startswith(("._", "compiled"))
-        ]
-        for file in tqdm(candidates, desc="Validating video files"):
-            dur = ffprobe_duration(file)
+        # scandir's DirEntry answers is_file() from the directory listing, without a stat per file.
+        with os.scandir(self.folder) as entries:
+            candidates: list[Path] = [
+                Path(entry.path) for entry in entries
+                if entry.is_file()
+                and os.path.splitext(entry.name)[1].lower() in valid_extensions
+                and not entry.name.lower().startswith(("._", "compiled"))
+            ]
+        # scandir order is filesystem dependent; sort so a seeded plan picks the same files every run
+        candidates.sort()
+        # ffprobe runs in its own process, so threads are enough to overlap the probes.
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+            probed_durations = list(tqdm(
+                executor.map(ffprobe_duration, candidates),
+                total=len(candidates),
+                desc="Validating video files"
+            ))
+        for file, dur in zip(candidates, probed_durations):
             if dur is None or dur < MIN_INPUT_VIDEO_LEN:
                 if DELETE_SMALL_FILES:
                     try:
@@ -59,22 +104,46 @@ class VideoCompiler:
             self._duration_map[file] = float(dur)
 
         if self.video_files:
-            durations = [self._duration_map[p] for p in self.video_files]
+            durations = np.array([self._duration_map[p] for p in self.video_files])
             min_floor = 1e-6
-            self._weights = [max(d, min_floor) for d in durations]
+            weights = np.maximum(durations, min_floor)
+            self._weights = weights / weights.sum()
+
+    def _plan_segments(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Picks a weighted-random source video, the ideal clip length and a start position for each bass
+        hit interval.
+
+        The plan is three parallel arrays: indices into self.video_files, clip lengths in seconds, and
+        start positions as a fraction of the source's free range (its length minus the clip), so they
+        stay valid when a clip length is adjusted later for drift.
+        """
+        random_clip_min = self.config["RANDOM_CLIP_MIN"]
+        random_clip_max = self.config["RANDOM_CLIP_MAX"]
+        gaps = np.diff(np.asarray(self.bass_hits, dtype=np.float64))
+        ideal_durs = np.maximum(random_clip_min, np.minimum(gaps, random_clip_max))
+        video_ids = self._rng.choice(len(self.video_files), size=len(gaps), p=self._weights)
+        start_fractions = self._rng.random(len(gaps))
+        return video_ids, ideal_durs, start_fractions
 
     def extract_random_segment(
-        self, video_path: Path, duration: float, vid_dur: float | None = None
+        self, video_path: Path, duration: float, vid_dur: float | None = None, start_fraction: float | None = None,
+        output_path: Path | None = None
     ) -> tuple[Path | None, float]:
-        """Extracts a random clip of a given duration from a video."""
+        """Extracts a random clip of a given duration from a video.
+
+        start_fraction places the clip within the video's free range; a random one is drawn if omitted.
+        The clip is written to output_path, or to a new temp file if omitted.
+        """
         if vid_dur is None:
             vid_dur = ffprobe_duration(video_path)
         if not vid_dur or vid_dur <= 0:
             return None, 0.0
 
         duration = min(duration, vid_dur)
-        start_time = random.uniform(0, max(0, vid_dur - duration))
-        seg_path = safe_tmp(".mp4")
+        if start_fraction is None:
+            start_fraction = self._rng.random()
+        start_time = start_fraction * max(0, vid_dur - duration)
+        seg_path = str(output_path) if output_path is not None else safe_tmp(".mp4")
 
         # Configuration toggle for choosing segment extraction type.
         if DO_FAST_VIDEO_GEN:
@@ -87,87 +156,224 @@ class VideoCompiler:
             start_time=f"{start_time:.6f}",
             video_path=str(video_path),
             duration=f"{duration:.6f}",
+            video_encoder=video_encoder_args(18),
+            threads=self._encode_threads,
             output_path=seg_path
         )
 
         try:
-            subprocess.run(cmd, check=True, capture_output=True)
-            actual_dur = ffprobe_duration(seg_path) or 0.0
+            if DO_FAST_VIDEO_GEN:
+                # Stream copy starts on the keyframe before start_time, so the length has to be probed
+                subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                actual_dur = ffprobe_duration(seg_path, persist=False) or 0.0
+            else:
+                # A re-encoded clip of a constant frame rate source is exactly its frame count long.
+                # Variable frame rate sources keep their timestamps, so use the reported output time.
+                progress = run_command(cmd)
+                stream_info = ffprobe_stream_info(video_path)
+                if stream_info["r_fps"] == stream_info["avg_fps"]:
+                    actual_dur = _progress_frames(progress) / stream_info["r_fps"]
+                else:
+                    actual_dur = _progress_seconds(progress)
             return Path(seg_path), actual_dur
         except subprocess.CalledProcessError:
             return None, 0.0
 
-    def extract_segments(self):
-        """Extracts segments for each bass hit interval, compensating for timing drift."""
+    def extract_segments(self, workers: int | None = None):
+        """Extracts segments for each bass hit interval in parallel, compensating for timing drift.
+
+        Up to ``workers`` ffmpeg processes run at once, each encoding with its share of the CPU cores,
+        and the next segment is dispatched as soon as one finishes. Each dispatched segment takes up the
+        drift measured so far that the segments still running don't already correct for.
+
+        Args:
+            workers (int | None): Number of concurrent ffmpeg processes. Defaults to ``os.cpu_count()``,
+                capped at ``HW_ENCODER_MAX_SESSIONS`` when re-encodes run on a hardware encoder.
+        """
         self.segments_dir.mkdir(exist_ok=True)
-        segments = []
-        random_clip_min = self.config["RANDOM_CLIP_MIN"]
-        random_clip_max = self.config["RANDOM_CLIP_MAX"]
+        cpu_count = os.cpu_count() or 1
+        workers = max(1, workers or cpu_count)
+        # Probe the encoder here, once, rather than from every worker thread at the same time
+        if not DO_FAST_VIDEO_GEN and active_hw_encoder():
+            workers = min(workers, HW_ENCODER_MAX_SESSIONS)
+        # Without a cap every ffmpeg starts a thread per core and the parallel jobs oversubscribe the CPU.
+        # A lone job gets ffmpeg's automatic count, which overcommits slightly to hide lookahead stalls.
+        self._encode_threads = 0 if workers == 1 else max(1, cpu_count // workers)
         self._cumulative_error = 0.0
 
-        for i in tqdm(range(len(self.bass_hits) - 1), desc="Extracting segments"):
-            ideal_dur = max(random_clip_min, min(self.bass_hits[i + 1] - self.bass_hits[i], random_clip_max))
-            adjusted_dur = ideal_dur - self._cumulative_error
+        # Plan every segment up front so a finished worker can be refilled without waiting on the loop.
+        video_ids, ideal_durs, start_fractions = self._plan_segments()
+        num_segments = len(ideal_durs)
 
-            chosen_video = random.choices(self.video_files, weights=self._weights, k=1)[0]
-            chosen_vid_dur = self._duration_map.get(chosen_video)
+        seg_paths: list[Path | None] = [None] * num_segments
+        running = {}                # future -> (segment index, drift correction it was dispatched with)
+        pending_correction = 0.0    # drift already folded into the running segments
+        next_index = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor, \
+                tqdm(total=num_segments, desc="Extracting segments") as progress:
+            while running or next_index < num_segments:
+                while next_index < num_segments and len(running) < workers:
+                    i = next_index
+                    correction = self._cumulative_error - pending_correction
+                    task = (
+                        self.video_files[video_ids[i]],
+                        ideal_durs[i] - correction,
+                        start_fractions[i],
+                        self.segments_dir / f"seg_{i:04d}.mp4",
+                    )
+                    running[executor.submit(self._extract_segment_task, task)] = (i, correction)
+                    pending_correction += correction
+                    next_index += 1
 
-            seg_path = self.segments_dir / f"seg_{i:04d}.mp4"
-            seg_file, actual_dur = self.extract_random_segment(chosen_video, adjusted_dur, vid_dur=chosen_vid_dur)
-
-            if seg_file:
-                shutil.move(seg_file, seg_path)
-                segments.append(seg_path)
-                self._cumulative_error += (actual_dur - ideal_dur)
-            else:
-                self._cumulative_error -= ideal_dur
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, correction = running.pop(future)
+                    pending_correction -= correction
+                    seg_path, actual_dur = future.result()
+                    if seg_path:
+                        seg_paths[i] = seg_path
+                        self._cumulative_error += (actual_dur - ideal_durs[i])
+                    else:
+                        self._cumulative_error -= ideal_durs[i]
+                    progress.update()
 
-        return segments
+        return [seg_path for seg_path in seg_paths if seg_path]
 
-    def concatenate_segments(self, segments: list[Path]) -> Path:
-        """Concatenates all video segments into a single file."""
-        file_list_path = self.folder / "file_list.txt"
-        with open(file_list_path, "w") as f:
-            for seg in segments:
-                f.write(f"file '{seg}'\n")
+    def _extract_segment_task(self, task: tuple[Path, float, float, Path]) -> tuple[Path | None, float]:
+        """Extracts one planned segment straight to its final path. Runs on a worker thread."""
+        video_path, duration, start_fraction, seg_path = task
+        return self.extract_random_segment(
+            video_path, duration, vid_dur=self._duration_map.get(video_path), start_fraction=start_fraction,
+            output_path=seg_path
+        )
 
-        temp_concat = self.folder / "concat.mp4"
+    def concatenate_segments(self, segments: list[Path]):
+        """Concatenates all video segments and muxes in the audio, writing the final output file."""
+        file_list = "".join(CONCAT_FILE_ENTRY.format(video_path=escape_concat_path(seg)) for seg in segments).encode()
 
         try:
-            logger.info("Concatenating segments...")
-            cmd = format_ffmpeg_cmd(
-                CONCAT_COPY_CMD,
-                file_list=file_list_path,
-                output_path=temp_concat
-            )
-            subprocess.run(cmd, check=True, capture_output=True)
+            logger.info("Concatenating segments and adding audio...")
+            cmd = format_ffmpeg_cmd(CONCAT_COPY_CMD, audio_path=self.mp3_path, output_path=self.output_path)
+            subprocess.run(cmd, input=file_list, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         except subprocess.CalledProcessError:
             cmd = format_ffmpeg_cmd(
                 CONCAT_REENCODE_CMD,
-                file_list=file_list_path,
-                output_path=temp_concat
+                audio_path=self.mp3_path,
+                video_encoder=video_encoder_args(18),
+                output_path=self.output_path
             )
-            subprocess.run(cmd, check=True, capture_output=True)
+            subprocess.run(cmd, input=file_list, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-        file_list_path.unlink()
-        return temp_concat
+    def render_single_pass(self):
+        """Cuts every planned segment straight from its source and joins them in one ffmpeg call,
+        muxing in the audio and writing the final output file.
 
-    def add_audio(self, concat_path: Path):
-        """Merges the audio file with the compiled video."""
-        logger.info("Adding audio...")
-        cmd = format_ffmpeg_cmd(
-            ADD_AUDIO_CMD,
-            video_path=concat_path,
-            audio_path=self.mp3_path,
-            output_path=self.output_path
-        )
-        subprocess.run(cmd, check=True, capture_output=True)
+        Fast mode stream-copies through the concat demuxer using inpoint/outpoint directives.
+        Otherwise each clip is an input-seeked ffmpeg input and the concat filter joins them into
+        a single encode. Clip lengths are snapped to whole frames on a shared timeline, so the
+        cuts stay on the bass hits without per-segment drift correction. Every input is a separate
+        decoder, so plans longer than SINGLE_PASS_MAX_INPUTS clips are encoded in parts of that
+        many clips, which concatenate_segments then joins and adds the audio to.
+        """
+        logger.info("Rendering segments in a single pass...")
+        video_ids, ideal_durs, start_fractions = self._plan_segments()
 
-    def cleanup(self, concat_path: Path):
+        if DO_FAST_VIDEO_GEN:
+            entries = []
+            for video_id, duration, start_fraction in zip(video_ids, ideal_durs, start_fractions):
+                video_path = self.video_files[video_id]
+                vid_dur = self._duration_map[video_path]
+                duration = min(duration, vid_dur)
+                start_time = start_fraction * max(0, vid_dur - duration)
+                entries.append(CONCAT_LIST_ENTRY.format(
+                    video_path=escape_concat_path(video_path),
+                    start_time=f"{start_time:.6f}",
+                    end_time=f"{start_time + duration:.6f}"
+                ))
+            cmd = format_ffmpeg_cmd(CONCAT_COPY_CMD, audio_path=self.mp3_path, output_path=self.output_path)
+            subprocess.run(
+                cmd, input="".join(entries).encode(), check=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            return
+
+        # Output format follows the first video; the filter graph conforms every clip to it.
+        stream_info = ffprobe_stream_info(self.video_files[0])
+        fps = stream_info["r_fps"]
+        clips = []      # (input arguments, frame count) per clip
+        ideal_time, timeline_frames = 0.0, 0
+        for video_id, duration, start_fraction in zip(video_ids, ideal_durs, start_fractions):
+            video_path = self.video_files[video_id]
+            ideal_time += duration
+            vid_dur = self._duration_map[video_path]
+            # Frames needed to land this cut on the ideal timeline, limited by the source length.
+            # Any shortfall is made up by the following clip.
+            frames = min(round(ideal_time * fps) - timeline_frames, int(vid_dur * fps))
+            if frames <= 0:
+                continue
+            timeline_frames += frames
+            clip_dur = frames / fps
+            start_time = start_fraction * max(0, vid_dur - clip_dur - 1 / fps)
+            clips.append((format_ffmpeg_cmd(
+                SINGLE_PASS_INPUT_ARGS,
+                start_time=f"{start_time:.6f}",
+                duration=f"{clip_dur + 1 / fps:.6f}",   # one frame of headroom for the trim
+                video_path=str(video_path)
+            ), frames))
+
+        if len(clips) <= SINGLE_PASS_MAX_INPUTS:
+            cmd, filter_graph = self._single_pass_graph(clips, stream_info)
+            cmd += format_ffmpeg_cmd(
+                SINGLE_PASS_OUTPUT_ARGS,
+                audio_path=self.mp3_path,
+                filter_graph=filter_graph,
+                audio_index=len(clips),
+                fps=fps,
+                video_encoder=video_encoder_args(18),
+                output_path=self.output_path
+            )
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            return
+
+        self.segments_dir.mkdir(exist_ok=True)
+        parts = []
+        for part_start in tqdm(range(0, len(clips), SINGLE_PASS_MAX_INPUTS), desc="Rendering parts"):
+            part_path = self.segments_dir / f"part_{len(parts):04d}.mp4"
+            cmd, filter_graph = self._single_pass_graph(
+                clips[part_start:part_start + SINGLE_PASS_MAX_INPUTS], stream_info
+            )
+            cmd += format_ffmpeg_cmd(
+                SINGLE_PASS_PART_OUTPUT_ARGS,
+                filter_graph=filter_graph,
+                fps=fps,
+                video_encoder=video_encoder_args(18),
+                output_path=part_path
+            )
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            parts.append(part_path)
+        self.concatenate_segments(parts)
+
+    @staticmethod
+    def _single_pass_graph(clips: list[tuple[list[str], int]], stream_info: dict) -> tuple[list[str], str]:
+        """Builds the command prefix with the clips' inputs and the filter graph joining them into [vout]."""
+        cmd = list(SINGLE_PASS_CMD)
+        filters = []
+        for input_args, frames in clips:
+            cmd += input_args
+            filters.append(SINGLE_PASS_SEGMENT_FILTER.format(
+                index=len(filters),
+                fps=stream_info["r_fps"],
+                frames=frames,
+                width=stream_info["width"],
+                height=stream_info["height"]
+            ))
+        labels = "".join(f"[v{i}]" for i in range(len(filters)))
+        return cmd, ";".join(filters + [f"{labels}concat=n={len(filters)}:v=1:a=0[vout]"])
+
+    def cleanup(self):
         """Cleans up intermediate files and folders."""
         logger.info("Cleaning up...")
-        concat_path.unlink()
-        shutil.rmtree(self.segments_dir)
+        shutil.rmtree(self.segments_dir, ignore_errors=True)
 
     def compile(self):
         """Runs the full compilation process."""
@@ -175,8 +381,10 @@ class VideoCompiler:
         if not self.video_files:
             logger.error("No valid videos.")
             return
-        segments = self.extract_segments()
-        concat_path = self.concatenate_segments(segments)
-        self.add_audio(concat_path)
-        self.cleanup(concat_path)
+        if DO_SINGLE_PASS_GEN:
+            self.render_single_pass()
+        else:
+            segments = self.extract_segments()
+            self.concatenate_segments(segments)
+        self.cleanup()
         logger.info(f"✅ Compiled video saved to:\n{self.output_path}")
@@ -5,50 +5,59 @@ from PyQt6.QtWidgets import (
 from PyQt6.QtCore import QThread, QObject, pyqtSignal, pyqtSlot, QTimer
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
+from functools import partial
 from pathlib import Path
-import librosa
+import numpy as np
 import sys
 from src.processors.bass_detector import BassDetector
-from src.util.util import ffprobe_duration, save_config, load_config
+from src.util.util import downsample_envelope, ffprobe_duration, save_config, load_config
 from config.global_config import DEBOUNCE_TIMEOUT
 from src.common.env import logger
 
+# Config keys that change the detection result. RANDOM_CLIP_MAX only matters to the video compiler.
+DETECTION_KEYS = ("LF_MIN_HZ", "LF_MAX_HZ", "ONSET_DELTA", "HOP_LENGTH", "RANDOM_CLIP_MIN")
+
 # ========= WORKER CLASS ============
 class DetectionWorker(QObject):
-    """Worker class to run bass detection and prepare plot data.
+    """Long-lived worker that runs bass detection and prepares plot data on its own thread.
+
+    Requests are numbered; only the most recent one is computed, and a result is dropped if a
+    newer request arrived while it ran.
 
     Emits:
-        finished (list, list, list, list, float): hits, dropped, times, onset_env, max_env
+        finished (list, list, np.ndarray, np.ndarray, float): hits, dropped, times, onset_env, max_env
     """
-    finished = pyqtSignal(list, list, list, list, float)
-    canceled = False
+    # The envelope arrays go through as plain objects; converting them to lists would box every frame
+    finished = pyqtSignal(list, list, object, object, float)
 
-    def __init__(self, audio_path: Path, config: dict):
+    def __init__(self):
         super().__init__()
-        self.audio_path = audio_path
-        self.config = config
+        # Written from the UI thread before each request is posted
+        self.latest_request = 0
 
-    @pyqtSlot()
-    def run(self):
+    def _is_stale(self, request_id: int) -> bool:
+        return request_id != self.latest_request
+
+    @pyqtSlot(int, str, dict)
+    def run(self, request_id: int, audio_path: str, config: dict):
         """Performs bass detection and preprocessing for the plot."""
-        detector = BassDetector(self.audio_path)
-        hits, dropped, times, onset_env = detector.detect(self.config)
+        if self._is_stale(request_id):
+            return
+
+        detector = BassDetector(Path(audio_path))
+        hits, dropped, times, onset_env = detector.detect(config)
 
-        if self.canceled:
+        if self._is_stale(request_id):
             return
 
-        mp3_dur = ffprobe_duration(self.audio_path)
+        mp3_dur = ffprobe_duration(audio_path)
         if hits and hits[-1] < mp3_dur:
             hits.append(mp3_dur)
 
-        if self.canceled:
+        if self._is_stale(request_id):
             return
 
-        hits = list(hits)
-        dropped = list(dropped)
-        times = list(times)
-        onset_env = list(onset_env)
-        max_env = max(onset_env) if onset_env else 1.0
+        max_env = float(onset_env.max()) if onset_env.size else 1.0
 
         self.finished.emit(hits, dropped, times, onset_env, max_env)
 
@@ -56,16 +65,16 @@ class DetectionWorker(QObject):
 class EditorUserInterface(QWidget):
     """Main UI for bass detection configuration and preview."""
 
+    detection_requested = pyqtSignal(int, str, dict)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Bass Detection Configurator")
 
         self.audio_path = None
-        self.y = None
-        self.sr = None
         self.bass_hits = []
-        self.thread = None
-        self.worker = None
+        self._request_id = 0
+        self._last_detection_key = None
         self._success = False  # default to 1, meaning user closed manually
 
         self.param_ranges = {
@@ -105,18 +114,51 @@ class EditorUserInterface(QWidget):
 
         self.canvas = FigureCanvas(Figure(figsize=(10, 4)))
         self.ax = self.canvas.figure.add_subplot(111)
+        self._init_plot()
 
         self._build_ui()
 
-        if self.audio_path:
-            self._choose_audio_file(self.audio_path)
+        # One worker thread for the lifetime of the window; requests reach it as queued signals.
+        self.thread = QThread()
+        self.worker = DetectionWorker()
+        self.worker.moveToThread(self.thread)
+        self.detection_requested.connect(self.worker.run)
+        self.worker.finished.connect(self._on_detection_result)
+        self.thread.start()
 
         self.debounce_timer = QTimer()
         self.debounce_timer.setSingleShot(True)
-        self.debounce_timer.timeout.connect(self._start_detection)
+        self.debounce_timer.timeout.connect(self._refresh_plot)
+
+        if self.audio_path:
+            self._choose_audio_file(self.audio_path)
 
         self.show()
 
+    def _init_plot(self):
+        """Creates the plot artists once; detection results only update their data.
+
+        The data artists are animated: a full draw renders only the static axes, which is saved as the
+        blit background, and the artists are blitted on top of it.
+        """
+        self.env_line, = self.ax.plot([], [], label="Onset Envelope", color='blue', animated=True)
+        self.kept_lines = self.ax.vlines([], 0, 1, color='red', label='Kept', linestyle='-', animated=True)
+        self.dropped_lines = self.ax.vlines([], 0, 1, color='orange', label='Dropped', linestyle='-', animated=True)
+        self.ax.set_title("Filtered Onsets")
+        self.ax.set_xlabel("Time (s)")
+        self.ax.legend()
+        self._plot_background = None
+        self.canvas.mpl_connect("draw_event", self._on_canvas_draw)
+
+    def _on_canvas_draw(self, event):
+        """Saves the freshly drawn static axes as the blit background and draws the data over it."""
+        self._plot_background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self._draw_plot_artists()
+
+    def _draw_plot_artists(self):
+        for artist in (self.env_line, self.kept_lines, self.dropped_lines):
+            self.ax.draw_artist(artist)
+
     def _build_ui(self):
         """Constructs layout and widget bindings."""
         layout = QVBoxLayout()
@@ -133,15 +175,16 @@ class EditorUserInterface(QWidget):
                 spin = QSpinBox()
                 spin.setRange(min_val, max_val)
                 spin.setValue(self.audio_detector_config[key])
-                spin.valueChanged.connect(lambda val, k=key: self._update_config(k, val))
             else:
                 spin = QDoubleSpinBox()
                 spin.setRange(min_val, max_val)
                 spin.setSingleStep(0.01)
                 spin.setDecimals(4)
                 spin.setValue(self.audio_detector_config[key])
-                spin.valueChanged.connect(lambda val, k=key: self._update_config(k, val))
 
+            # Typed values only commit on Enter or focus loss instead of on every keystroke
+            spin.setKeyboardTracking(False)
+            spin.valueChanged.connect(partial(self._update_config, key))
             box.addWidget(spin)
             layout.addLayout(box)
 
@@ -169,24 +212,6 @@ class EditorUserInterface(QWidget):
             self.debounce_timer.stop()
         self.debounce_timer.start(DEBOUNCE_TIMEOUT)
 
-    def _start_detection(self):
-        """Starts detection thread after debounce delay."""
-        if self.audio_path is None or self.y is None:
-            return
-
-        if self.thread and self.thread.isRunning():
-            self.worker.canceled = True
-            self.thread.quit()
-            self.thread.wait()
-
-        self.worker = DetectionWorker(self.audio_path, dict(self.audio_detector_config))
-        self.thread = QThread()
-        self.worker.moveToThread(self.thread)
-        self.thread.started.connect(self.worker.run)
-        self.worker.finished.connect(self._on_detection_result)
-        self.worker.finished.connect(self.thread.quit)
-        self.thread.start()
-
     def _choose_audio_file(self, file_path: Path = None):
         """Loads an audio file and updates plot.
 
@@ -205,26 +230,26 @@ class EditorUserInterface(QWidget):
 
         self.audio_path = file_path
         self.audio_detector_config["AUDIO_PATH"] = str(file_path)
-        self.y, self.sr = librosa.load(self.audio_path, mono=True)
+        # No decode here; the detector decodes once, at the reduced rate it analyzes, and memoizes it.
         self._refresh_plot()
 
     def _refresh_plot(self):
-        """Starts worker thread to run detection and prepare plot data."""
-        if self.audio_path is None or self.y is None:
+        """Posts a detection request for the current config to the worker thread.
+
+        Nothing is posted if the audio file and detection parameters match the last request.
+        """
+        if self.audio_path is None:
             return
 
-        if self.thread and self.thread.isRunning():
-            self.worker.canceled = True
-            self.thread.quit()
-            self.thread.wait()
+        key = (str(self.audio_path), *(self.audio_detector_config.get(k) for k in DETECTION_KEYS))
+        if key == self._last_detection_key:
+            return
+        self._last_detection_key = key
 
-        self.worker = DetectionWorker(self.audio_path, dict(self.audio_detector_config))
-        self.thread = QThread()
-        self.worker.moveToThread(self.thread)
-        self.thread.started.connect(self.worker.run)
-        self.worker.finished.connect(self._on_detection_result)
-        self.worker.finished.connect(self.thread.quit)
-        self.thread.start()
+        # Supersedes any request still queued or running on the worker
+        self._request_id += 1
+        self.worker.latest_request = self._request_id
+        self.detection_requested.emit(self._request_id, str(self.audio_path), dict(self.audio_detector_config))
 
     def _on_detection_result(self, hits, dropped, times, onset_env, max_env):
         """Handles the results from worker and updates the plot.
@@ -232,21 +257,38 @@ class EditorUserInterface(QWidget):
         Args:
             hits (list): Times of kept bass hits.
             dropped (list): Dropped onset times.
-            times (list): Onset envelope time axis.
-            onset_env (list): Onset envelope values.
+            times (np.ndarray): Onset envelope time axis.
+            onset_env (np.ndarray): Onset envelope values.
             max_env (float): Maximum envelope value.
         """
         self.bass_hits = hits
         self.bass_label.setText(f"Detected Bass Hits: {len(hits)}")
 
-        self.ax.clear()
-        self.ax.plot(times, onset_env, label="Onset Envelope", color='blue')
-        self.ax.vlines(hits, 0, max_env, color='red', label='Kept', linestyle='-')
-        self.ax.vlines(dropped, 0, max_env, color='orange', label='Dropped', linestyle='-')
-        self.ax.set_title("Filtered Onsets")
-        self.ax.set_xlabel("Time (s)")
-        self.ax.legend()
-        self.canvas.draw()
+        # Two points per pixel column is all the line can show
+        width = self.canvas.get_width_height()[0]
+        self.env_line.set_data(*downsample_envelope(times, onset_env, 2 * width))
+        self.kept_lines.set_segments(self._vline_segments(hits, max_env))
+        self.dropped_lines.set_segments(self._vline_segments(dropped, max_env))
+
+        # Only a change of axis limits (new ticks) needs a full redraw; otherwise blit the artists
+        # over the saved background.
+        limits = (self.ax.get_xlim(), self.ax.get_ylim())
+        self.ax.relim()
+        self.ax.autoscale_view()
+        if self._plot_background is None or limits != (self.ax.get_xlim(), self.ax.get_ylim()):
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self._plot_background)
+        self._draw_plot_artists()
+        self.canvas.blit(self.canvas.figure.bbox)
+
+    @staticmethod
+    def _vline_segments(xs, height: float) -> np.ndarray:
+        """Builds LineCollection segments for vertical lines from 0 to height at each x."""
+        segments = np.zeros((len(xs), 2, 2))
+        segments[:, :, 0] = np.asarray(xs, dtype=float)[:, None]
+        segments[:, 1, 1] = height
+        return segments
 
     def _on_generate_clicked(self):
         """Handles Generate button click."""
@@ -258,6 +300,13 @@ class EditorUserInterface(QWidget):
         save_config(self.audio_detector_config)
         self.close()
 
+    def closeEvent(self, event):
+        """Stops the worker thread when the window closes."""
+        self.worker.latest_request = -1  # drop whatever is still queued
+        self.thread.quit()
+        self.thread.wait()
+        super().closeEvent(event)
+
     def get_final_config(self):
         """Returns final config and results.
 
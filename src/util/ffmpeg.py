@@ -1,8 +1,37 @@
+import subprocess
+from functools import lru_cache
 from pathlib import Path
+from config.global_config import USE_HW_ENCODER
+
+# Flags for every ffmpeg call that doesn't read stdin. Segments are cut by many ffmpeg processes
+# at once; without -nostdin each one polls the terminal for interactive keys and can stall on it.
+QUIET_ARGS = ["-nostdin", "-v", "error"]
+
+# Video encoder argument templates, spliced in wherever a command template has "{video_encoder}".
+# {crf} is the libx264-style quality target. The hardware encoders get the same number on their own
+# quality scale (-cq, -global_quality, or -q:v mapped from it), which is a rough stand-in, not the
+# same visual quality or file size as libx264 at that CRF.
+SOFTWARE_ENCODER_ARGS = ["-c:v", "libx264", "-preset", "veryfast", "-crf", "{crf}"]
+HW_ENCODER_ARGS = {
+    "h264_nvenc": ["-c:v", "h264_nvenc", "-preset", "p4", "-rc", "vbr", "-cq", "{crf}", "-b:v", "0"],
+    "h264_videotoolbox": ["-c:v", "h264_videotoolbox", "-q:v", "{vt_quality}"],
+    "h264_qsv": ["-c:v", "h264_qsv", "-global_quality", "{crf}"],
+}
+# Consumer GPUs limit how many encode sessions run at once, so parallel re-encodes are capped to this
+HW_ENCODER_MAX_SESSIONS = 3
+
+# Tiny synthetic encode used to check that a listed hardware encoder actually works on this machine
+HW_ENCODER_TEST_CMD = [
+    "ffmpeg", *QUIET_ARGS,
+    "-f", "lavfi", "-i", "color=black:s=256x256:r=30:d=0.1",
+    "-pix_fmt", "yuv420p",
+    "{video_encoder}",
+    "-f", "null", "-"
+]
 
 # Segment extraction command template. Faster by using chunks of video.
 FAST_COPY_EXTRACT_CMD = [
-    "ffmpeg", "-y",
+    "ffmpeg", *QUIET_ARGS, "-y",
     "-ss", "{start_time}",
     "-i", "{video_path}",
     "-t", "{duration}",
@@ -13,54 +42,122 @@ FAST_COPY_EXTRACT_CMD = [
     "{output_path}"
 ]
 
-# Slow (frame-accurate) segment extraction command template
+# Slow (frame-accurate) segment extraction command template. The progress report on stdout carries
+# the encoded frame count, which gives the clip length without probing the output afterwards.
 FRAME_ACCURATE_EXTRACT_CMD = [
-    "ffmpeg", "-y",
+    "ffmpeg", *QUIET_ARGS, "-y",
     "-ss", "{start_time}",        # start time (before input still works, but slower)
     "-i", "{video_path}",         # input video
     "-t", "{duration}",           # duration of clip
-    "-c:v", "libx264",            # re-encode video for precise trimming
-    "-preset", "veryfast",        # preset for speed/efficiency
-    "-crf", "18",                 # high quality
-    "-c:a", "aac",                # re-encode audio
-    "-b:a", "192k",               # audio bitrate
+    "{video_encoder}",            # re-encode video for precise trimming (see video_encoder_args)
+    "-threads", "{threads}",      # encoder threads, 0 = auto
+    "-an",                        # no audio; concatenation only takes the video stream
     "-pix_fmt", "yuv420p",        # pixel format for broad compatibility
+    "-video_track_timescale", "90000",  # same time base for every clip, so concat can stream-copy them
+    "-progress", "pipe:1",        # key=value progress report on stdout
+    "-nostats",
     "{output_path}"               # output file
 ]
 
-# Concatenation (copy) command template
+# Concatenation (copy) command template. The file list is streamed to ffmpeg's stdin instead of
+# being written to disk; "pipe" has to be whitelisted for the concat demuxer to read it.
+# The audio track is muxed in the same call, so the joined video is never written on its own.
 CONCAT_COPY_CMD = [
-    "ffmpeg", "-y", "-f", "concat", "-safe", "0",
-    "-i", "{file_list}", "-c", "copy", "{output_path}"
+    "ffmpeg", "-v", "error", "-y", "-protocol_whitelist", "file,pipe", "-f", "concat", "-safe", "0",
+    "-i", "pipe:0",
+    "-i", "{audio_path}",
+    "-map", "0:v:0",    # take video from the concat list
+    "-map", "1:a:0",    # take audio from the audio file
+    "-c:v", "copy",     # copy video without re-encoding
+    "-c:a", "aac",      # re-encode audio to AAC
+    "-shortest",        # cut to the shortest of video or audio
+    "{output_path}"
 ]
 
 # Concatenation (re-encode fallback) command template
 CONCAT_REENCODE_CMD = [
-    "ffmpeg", "-y", "-f", "concat", "-safe", "0",
-    "-i", "{file_list}",
-    "-c:v", "libx264", "-preset", "veryfast", "-crf", "14",
+    "ffmpeg", "-v", "error", "-y", "-protocol_whitelist", "file,pipe", "-f", "concat", "-safe", "0",
+    "-i", "pipe:0",
+    "-i", "{audio_path}",
+    "-map", "0:v:0",
+    "-map", "1:a:0",
+    "{video_encoder}",
     "-pix_fmt", "yuv420p",
+    "-c:a", "aac",
+    "-shortest",
     "-movflags", "+faststart",
     "{output_path}"
 ]
 
-# Add audio command template
-ADD_AUDIO_CMD = [
-    "ffmpeg", "-y",
-    "-i", "{video_path}",
+# Concat demuxer list entries. Paths carry an explicit file: protocol, otherwise ffmpeg resolves
+# them relative to the "pipe:" list URL. {video_path} goes inside single quotes, so format it
+# with escape_concat_path.
+CONCAT_FILE_ENTRY = "file 'file:{video_path}'\n"
+
+# Concat demuxer list entry that cuts a segment straight out of its source video
+CONCAT_LIST_ENTRY = "file 'file:{video_path}'\ninpoint {start_time}\noutpoint {end_time}\n"
+
+# Single-pass encode command prefix, followed by the segment inputs and output arguments below
+SINGLE_PASS_CMD = ["ffmpeg", *QUIET_ARGS, "-y"]
+
+# Per-segment input arguments for the single-pass encode (input seeking, so only the clip is decoded)
+SINGLE_PASS_INPUT_ARGS = [
+    "-ss", "{start_time}",
+    "-t", "{duration}",
+    "-i", "{video_path}"
+]
+
+# Per-segment filter chain for the single-pass encode. Conforms every clip to the output frame
+# rate and size and trims it to an exact frame count.
+SINGLE_PASS_SEGMENT_FILTER = (
+    "[{index}:v]fps={fps},trim=end_frame={frames},setpts=PTS-STARTPTS,"
+    "scale={width}:{height}:force_original_aspect_ratio=decrease,"
+    "pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1[v{index}]"
+)
+
+# Single-pass encode output arguments, appended after all segment inputs. The audio file is the
+# last input ({audio_index}) and is muxed in the same call.
+SINGLE_PASS_OUTPUT_ARGS = [
     "-i", "{audio_path}",
-    "-map", "0:v:0",    # take video from first input
-    "-map", "1:a:0",    # take audio from second input
-    "-c:v", "copy",     # copy video without re-encoding
-    "-c:a", "aac",      # re-encode audio to AAC
-    "-shortest",        # cut to the shortest of video or audio
+    "-filter_complex", "{filter_graph}",
+    "-map", "[vout]",
+    "-map", "{audio_index}:a:0",
+    "-r", "{fps}",                # the concat filter doesn't carry the frame rate through
+    "{video_encoder}",
+    "-pix_fmt", "yuv420p",
+    "-c:a", "aac",
+    "-shortest",
     "{output_path}"
 ]
 
+# Output arguments for one part of a single-pass encode that is split over several ffmpeg calls.
+# Parts are video only; the audio is muxed in when concatenate_segments joins them.
+SINGLE_PASS_PART_OUTPUT_ARGS = [
+    "-filter_complex", "{filter_graph}",
+    "-map", "[vout]",
+    "-r", "{fps}",
+    "{video_encoder}",
+    "-pix_fmt", "yuv420p",
+    "{output_path}"
+]
+
+# Audio decode command template. Streams mono float32 PCM to stdout.
+DECODE_AUDIO_CMD = [
+    "ffmpeg", *QUIET_ARGS,
+    "-i", "{audio_path}",
+    "-f", "f32le",          # raw little-endian float32 samples
+    "-ac", "1",             # downmix to mono
+    "-ar", "{sample_rate}", # resample with ffmpeg's resampler
+    "pipe:1"
+]
+
 def format_ffmpeg_cmd(cmd_template: list[str], **kwargs) -> list[str]:
     """
     Replaces placeholders in a ffmpeg command template with keyword arguments.
-    
+
+    An argument that is exactly one placeholder whose value is a list (e.g. "{video_encoder}")
+    is replaced by all of that list's items.
+
     Args:
         cmd_template (list[str]): The ffmpeg command template with placeholders.
         **kwargs: Placeholder replacements as keyword arguments.
@@ -68,4 +165,61 @@ def format_ffmpeg_cmd(cmd_template: list[str], **kwargs) -> list[str]:
     Returns:
         list[str]: Fully formatted command ready to pass to subprocess.run.
     """
-    return [arg.format(**kwargs) for arg in cmd_template]
+    cmd = []
+    for arg in cmd_template:
+        value = kwargs.get(arg[1:-1]) if arg.startswith("{") and arg.endswith("}") else None
+        if isinstance(value, list):
+            cmd.extend(str(v) for v in value)
+        else:
+            cmd.append(arg.format(**kwargs))
+    return cmd
+
+
+@lru_cache(maxsize=None)
+def detect_hw_encoder() -> str | None:
+    """Returns the first hardware H.264 encoder that ffmpeg lists and can actually run, or None.
+
+    The result is cached for the life of the process.
+    """
+    try:
+        listed = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"], check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        ).stdout.decode("utf-8", errors="ignore")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    for encoder in HW_ENCODER_ARGS:
+        if encoder not in listed:
+            continue
+        test_cmd = format_ffmpeg_cmd(HW_ENCODER_TEST_CMD, video_encoder=_encoder_args(encoder, 23))
+        if subprocess.run(test_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            return encoder
+    return None
+
+
+def video_encoder_args(crf: int) -> list[str]:
+    """Returns the ffmpeg video encoder arguments for a libx264-style quality target.
+
+    Uses a working hardware encoder when USE_HW_ENCODER is on, libx264 otherwise.
+    """
+    return _encoder_args(active_hw_encoder(), crf)
+
+
+def active_hw_encoder() -> str | None:
+    """Returns the hardware encoder re-encodes will use, or None when they run on libx264."""
+    return detect_hw_encoder() if USE_HW_ENCODER else None
+
+
+def _encoder_args(encoder: str | None, crf: int) -> list[str]:
+    template = HW_ENCODER_ARGS.get(encoder, SOFTWARE_ENCODER_ARGS)
+    # VideoToolbox quality runs 1-100 (higher is better); map CRF 18 -> 64, CRF 14 -> 72.
+    return format_ffmpeg_cmd(template, crf=crf, vt_quality=max(1, min(100, 100 - 2 * crf)))
+
+
+def escape_concat_path(path) -> str:
+    """Escapes a path for a single-quoted concat demuxer list entry.
+
+    A quote can't be escaped inside single quotes, so each one closes the quoted string, adds an
+    escaped quote and reopens it ("'" becomes "'\\''").
+    """
+    return str(path).replace("'", "'\\''")
@@ -1,9 +1,31 @@
+import atexit
+import hashlib
+import json
+import os
 import subprocess
 import tempfile
-import matplotlib.pyplot as plt
+import threading
+from functools import lru_cache
+import numpy as np
 import yaml
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from pathlib import Path
-from src.common.constants import DEFAULT_CONFIG_PATH
+from src.common.constants import CACHE_DIR, DEFAULT_CONFIG_PATH
+from src.util.ffmpeg import DECODE_AUDIO_CMD, format_ffmpeg_cmd
+
+# libyaml's C parser and emitter when PyYAML was built with it, the pure-Python ones otherwise
+try:
+    from yaml import CSafeDumper as YamlDumper, CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeDumper as YamlDumper, SafeLoader as YamlLoader
+
+# Durations probed in earlier runs, keyed by "abs_path:mtime_ns:size". Loaded on first use and
+# written back at exit if anything was added.
+PROBE_CACHE_PATH = CACHE_DIR / "probe_cache.json"
+_probe_cache: dict[str, float] | None = None
+_probe_cache_dirty = False
+_probe_cache_lock = threading.Lock()
 
 
 def save_config(config: dict, path: Path = DEFAULT_CONFIG_PATH) -> None:
@@ -15,7 +37,7 @@ def save_config(config: dict, path: Path = DEFAULT_CONFIG_PATH) -> None:
         path (Path, optional): Path where the YAML file should be written.
     """
     with path.open("w") as f:
-        yaml.dump(config, f, default_flow_style=False)
+        yaml.dump(config, f, Dumper=YamlDumper, default_flow_style=False)
 
 
 def load_config(path: Path = DEFAULT_CONFIG_PATH) -> dict:
@@ -29,29 +51,71 @@ def load_config(path: Path = DEFAULT_CONFIG_PATH) -> dict:
 
     """
     with path.open("r") as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=YamlLoader)
+
+
+def file_digest(path) -> str:
+    """Return a BLAKE2b hex digest of a file's contents, memoized per file version (path, size, mtime)."""
+    stat = os.stat(path)
+    return _file_digest_cached(str(path), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=None)
+def _file_digest_cached(path: str, size: int, mtime_ns: int) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, hashlib.blake2b).hexdigest()
 
 
 def run_command(cmd):
     """Run a shell command and return stdout as a decoded string."""
-    res = subprocess.run(cmd, check=True, capture_output=True)
+    res = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
     return res.stdout.decode("utf-8", errors="ignore")
 
 
-def plot_onsets(times, onset_env, kept_onsets, dropped_onsets, plot_path):
-    """Save a plot visualizing detected bass hits."""
-    plt.figure(figsize=(12, 4))
-    plt.plot(times, onset_env, label="Bass Onset Envelope", color='blue')
-    plt.vlines(kept_onsets, 0, onset_env.max(), color='red', alpha=0.8, linestyle='-', label="Kept Bass Hits")
-    if dropped_onsets:
-        plt.vlines(dropped_onsets, 0, onset_env.max(), color='orange', alpha=0.8, linestyle='--', label="Dropped Bass Hits")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Energy")
-    plt.title("Detected Bass Hits (Filtered)")
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(plot_path)
-    plt.close()
+def downsample_envelope(times, values, max_points: int) -> tuple[np.ndarray, np.ndarray]:
+    """Reduce an envelope to at most max_points for plotting, keeping the shape it draws.
+
+    Envelopes longer than max_points are split into max_points // 2 contiguous buckets covering every
+    sample, and each bucket is replaced by its minimum and maximum at the bucket's start time. Drawn
+    at one bucket per pixel column, this covers the same pixels as the full envelope, so every peak
+    stays visible.
+    """
+    times = np.asarray(times)
+    values = np.asarray(values)
+    if len(values) <= max_points:
+        return times, values
+    num_buckets = max(1, max_points // 2)
+    starts = np.arange(num_buckets) * len(values) // num_buckets
+    minima = np.minimum.reduceat(values, starts)
+    maxima = np.maximum.reduceat(values, starts)
+    return np.repeat(times[starts], 2), np.column_stack((minima, maxima)).ravel()
+
+
+def plot_onsets(times, onset_env, kept_onsets, dropped_onsets, plot_path, max_points: int = 2400):
+    """Save a plot visualizing detected bass hits.
+
+    Renders on a standalone Agg canvas without pyplot's global state, so it can run on a worker
+    thread. The envelope is reduced to max_points with downsample_envelope, two per pixel column of
+    the 1200 pixel wide figure.
+    """
+    onset_env = np.asarray(onset_env)
+    env_max = onset_env.max() if onset_env.size else 1.0
+    times, onset_env = downsample_envelope(times, onset_env, max_points)
+
+    # Fixed margins instead of tight_layout, which needs an extra draw pass to measure the labels
+    fig = Figure(figsize=(12, 4), layout=None)
+    fig.subplots_adjust(left=0.06, right=0.99, top=0.92, bottom=0.12)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.plot(times, onset_env, label="Bass Onset Envelope", color='blue')
+    ax.vlines(kept_onsets, 0, env_max, color='red', alpha=0.8, linestyle='-', label="Kept Bass Hits")
+    if len(dropped_onsets):
+        ax.vlines(dropped_onsets, 0, env_max, color='orange', alpha=0.8, linestyle='--', label="Dropped Bass Hits")
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel("Energy")
+    ax.set_title("Detected Bass Hits (Filtered)")
+    ax.legend()
+    fig.savefig(plot_path)
 
 
 def safe_tmp(suffix):
@@ -59,10 +123,67 @@ def safe_tmp(suffix):
 
 
 # TODO consider using formatted commands similar to the ffmpeg formatting
-def ffprobe_duration(path):
+def ffprobe_duration(path, persist: bool = True):
+    """Return the duration of a media file in seconds, or None if it can't be probed.
+
+    Results are memoized per file version (path, size, mtime), so repeated lookups
+    of an unchanged file don't spawn another ffprobe process. With persist, they are also
+    kept in a JSON sidecar under CACHE_DIR so later runs skip the probe; turn it off for
+    short-lived files like extracted segments.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if not persist:
+        return _ffprobe_duration_cached(str(path), stat.st_size, stat.st_mtime_ns)
+
+    key = f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+    with _probe_cache_lock:
+        cached = _load_probe_cache().get(key)
+    if cached is not None:
+        return cached
+    duration = _ffprobe_duration_cached(str(path), stat.st_size, stat.st_mtime_ns)
+    if duration is not None:
+        global _probe_cache_dirty
+        with _probe_cache_lock:
+            _probe_cache[key] = duration
+            _probe_cache_dirty = True
+    return duration
+
+
+def _load_probe_cache() -> dict[str, float]:
+    """Return the persistent probe cache, reading it from disk on first use. Call with the lock held."""
+    global _probe_cache
+    if _probe_cache is None:
+        try:
+            _probe_cache = json.loads(PROBE_CACHE_PATH.read_text())
+        except (OSError, ValueError):
+            _probe_cache = {}
+        atexit.register(_save_probe_cache)
+    return _probe_cache
+
+
+def _save_probe_cache():
+    """Write the probe cache back to disk, dropping entries for files that no longer exist."""
+    with _probe_cache_lock:
+        if not _probe_cache_dirty:
+            return
+        entries = {k: v for k, v in _probe_cache.items() if os.path.exists(k.rsplit(":", 2)[0])}
+    try:
+        PROBE_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = PROBE_CACHE_PATH.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(entries))
+        os.replace(tmp_path, PROBE_CACHE_PATH)
+    except OSError:
+        pass
+
+
+@lru_cache(maxsize=None)
+def _ffprobe_duration_cached(path: str, size: int, mtime_ns: int):
     cmd = [
         "ffprobe", "-v", "error", "-show_entries", "format=duration",
-        "-of", "default=noprint_wrappers=1:nokey=1", str(path)
+        "-of", "default=noprint_wrappers=1:nokey=1", path
     ]
     try:
         return float(run_command(cmd).strip())
@@ -71,19 +192,81 @@ def ffprobe_duration(path):
 
 
 def ffprobe_stream_info(path):
+    """Return the frame rate and frame size of the first video stream.
+
+    r_fps is the stream's base frame rate and avg_fps its average; they differ for variable frame
+    rate sources. Falls back to 30 fps and 1920x1080 for anything that can't be probed. Memoized
+    per file version, like ffprobe_duration; the returned dict is shared, so don't modify it.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {"r_fps": 30.0, "avg_fps": 30.0, "width": 1920, "height": 1080}
+    return _ffprobe_stream_info_cached(str(path), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=None)
+def _ffprobe_stream_info_cached(path: str, size: int, mtime_ns: int):
     cmd = [
         "ffprobe", "-v", "error",
         "-select_streams", "v:0",
-        "-show_entries", "stream=r_frame_rate,avg_frame_rate",
-        "-of", "default=noprint_wrappers=1:nokey=1",
-        str(path)
+        "-show_entries", "stream=r_frame_rate,avg_frame_rate,width,height",
+        "-of", "json",
+        path
     ]
+    info = {"r_fps": 30.0, "avg_fps": 30.0, "width": 1920, "height": 1080}
     try:
-        lines = run_command(cmd).splitlines()
-        for line in lines:
-            if '/' in line:
-                num, den = line.split('/')
-                return {"r_fps": float(num) / float(den)}
+        stream = json.loads(run_command(cmd))["streams"][0]
+        num, den = stream["r_frame_rate"].split('/')
+        if float(den) > 0:
+            info["r_fps"] = info["avg_fps"] = float(num) / float(den)
+        num, den = stream.get("avg_frame_rate", "0/0").split('/')
+        if float(den) > 0:
+            info["avg_fps"] = float(num) / float(den)
+        info["width"] = int(stream.get("width", info["width"]))
+        info["height"] = int(stream.get("height", info["height"]))
     except Exception:
         pass
-    return {"r_fps": 30.0}
+    return info
+
+
+def ffprobe_sample_rate(path):
+    """Return the sample rate of the first audio stream in Hz, or None if it can't be probed.
+
+    Memoized per file version, like ffprobe_duration.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return _ffprobe_sample_rate_cached(str(path), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=None)
+def _ffprobe_sample_rate_cached(path: str, size: int, mtime_ns: int):
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "a:0",
+        "-show_entries", "stream=sample_rate",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        path
+    ]
+    try:
+        return int(run_command(cmd).strip())
+    except Exception:
+        return None
+
+
+def load_audio(path, sample_rate: int) -> np.ndarray:
+    """Decode an audio file to a mono float32 signal using an ffmpeg pipe.
+
+    Args:
+        path: Path to the audio file.
+        sample_rate (int): Sample rate to decode to; ffmpeg resamples as needed.
+
+    Returns:
+        np.ndarray: Mono float32 samples.
+    """
+    cmd = format_ffmpeg_cmd(DECODE_AUDIO_CMD, audio_path=str(path), sample_rate=int(sample_rate))
+    res = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return np.frombuffer(res.stdout, dtype=np.float32)
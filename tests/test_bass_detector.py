@@ -0,0 +1,131 @@
+import os
+import shutil
+import wave
+from pathlib import Path
+
+import numpy as np
+import pytest
+from scipy.ndimage import median_filter
+from scipy.signal import resample_poly
+
+import src.processors.bass_detector as bd
+from src.processors.bass_detector import BassDetector
+
+SAMPLE_RATE = 44100
+KICK_TIMES = np.arange(0.5, 12.0, 0.5)
+
+
+def _write_kick_track(path: Path):
+    """Writes a mono 16-bit wav of decaying 55 Hz kicks at KICK_TIMES over a little noise."""
+    rng = np.random.default_rng(0)
+    signal = 0.01 * rng.standard_normal(int(12.5 * SAMPLE_RATE))
+    t = np.arange(int(0.25 * SAMPLE_RATE)) / SAMPLE_RATE
+    kick = np.sin(2 * np.pi * 55 * t) * np.exp(-t / 0.05)
+    for start in (KICK_TIMES * SAMPLE_RATE).astype(int):
+        signal[start:start + kick.size] += kick
+    with wave.open(str(path), "wb") as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(SAMPLE_RATE)
+        out.writeframes((np.clip(signal, -1, 1) * 32767).astype("<i2").tobytes())
+
+
+def _load_wav(path, sample_rate: int) -> np.ndarray:
+    """Stands in for load_audio without ffmpeg: reads a mono 16-bit wav and resamples it to sample_rate."""
+    with wave.open(str(path), "rb") as wav:
+        native_rate = wav.getframerate()
+        signal = np.frombuffer(wav.readframes(wav.getnframes()), dtype="<i2") / 32768.0
+    return resample_poly(signal, sample_rate, native_rate).astype(np.float32)
+
+
+@pytest.fixture
+def kick_track(tmp_path, monkeypatch):
+    monkeypatch.setattr(bd, "load_audio", _load_wav)
+    monkeypatch.setattr(bd, "ffprobe_sample_rate", lambda path: SAMPLE_RATE)
+    monkeypatch.setattr(bd, "CACHE_DIR", tmp_path / "cache")
+    path = tmp_path / "kicks.wav"
+    _write_kick_track(path)
+    return path
+
+
+def _detect(path: Path, hop_length: int, decimate: bool, monkeypatch) -> np.ndarray:
+    shutil.rmtree(bd.CACHE_DIR, ignore_errors=True)
+    bd._band_onset_envelope.cache_clear()
+    bd._decoded_audio.cache_clear()
+    monkeypatch.setattr(bd, "MIN_ANALYSIS_SR", bd.MIN_ANALYSIS_SR if decimate else 10**9)
+    config = {"LF_MIN_HZ": 20, "LF_MAX_HZ": 150, "ONSET_DELTA": 0.2, "HOP_LENGTH": hop_length, "RANDOM_CLIP_MIN": 0.2}
+    return np.asarray(BassDetector(path).detect(config)[0])
+
+
+def _nearest_hits(hits: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    return hits[np.abs(hits[:, None] - reference[None, :]).argmin(axis=0)]
+
+
+@pytest.mark.parametrize("hop_length", [128, 256, 512, 1024])
+def test_decimated_hits_match_undecimated(kick_track, monkeypatch, hop_length):
+    decimated = _detect(kick_track, hop_length, True, monkeypatch)
+    undecimated = _detect(kick_track, hop_length, False, monkeypatch)
+
+    # Compare the hits each path places nearest to every kick, so a single missed kick can't skew the offset
+    offsets = _nearest_hits(decimated, KICK_TIMES) - _nearest_hits(undecimated, KICK_TIMES)
+    frame_seconds = hop_length / SAMPLE_RATE
+    assert abs(np.median(offsets)) <= max(0.005, frame_seconds / 2)
+    assert np.mean(np.abs(offsets) <= max(0.01, frame_seconds)) >= 0.75
+
+
+@pytest.mark.parametrize("hop_length", [64, 128, 256, 512])
+def test_every_kick_is_found(kick_track, monkeypatch, hop_length):
+    hits = _detect(kick_track, hop_length, True, monkeypatch)
+
+    errors = _nearest_hits(hits, KICK_TIMES) - KICK_TIMES
+    assert np.all(np.abs(errors) <= 0.03)
+
+
+def test_cached_result_is_read_only(kick_track):
+    config = {"LF_MIN_HZ": 20, "LF_MAX_HZ": 150, "ONSET_DELTA": 0.2, "HOP_LENGTH": 512, "RANDOM_CLIP_MIN": 0.2}
+    hits, _, times, onset_envelope = BassDetector(kick_track).detect(config)
+    cached_hits, _, cached_times, cached_envelope = BassDetector(kick_track).detect(config)
+
+    assert cached_hits == hits
+    np.testing.assert_array_equal(cached_envelope, onset_envelope)
+    assert not cached_times.flags.writeable and not cached_envelope.flags.writeable
+
+
+def test_result_cache_keeps_most_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(bd, "RESULT_CACHE_MAX_FILES", 3)
+    for i in range(5):
+        entry = tmp_path / f"{i}.npz"
+        entry.touch()
+        os.utime(entry, ns=(i * 10**9, i * 10**9))
+
+    bd._prune_result_cache(tmp_path)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["2.npz", "3.npz", "4.npz"]
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, 6, 101])
+def test_median5_matches_ndimage(size):
+    values = np.random.default_rng(size).standard_normal(size).astype(np.float32)
+
+    np.testing.assert_array_equal(bd._median5(values), median_filter(values, size=5))
+
+
+@pytest.mark.parametrize("hop_length", [128, 512])
+def test_spectral_flux_matches_librosa(kick_track, hop_length):
+    librosa = pytest.importorskip("librosa")
+    signal = _load_wav(kick_track, SAMPLE_RATE).astype(np.float64)
+
+    expected = librosa.onset.onset_strength(y=signal, sr=SAMPLE_RATE, hop_length=hop_length, n_fft=bd.N_FFT)
+    flux = bd._spectral_flux(signal, SAMPLE_RATE, hop_length, bd.N_FFT, SAMPLE_RATE, 1 + bd.N_FFT // (2 * hop_length))
+
+    np.testing.assert_allclose(flux, expected, rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize("delta, wait", [(0.05, 0), (0.2, 3), (0.5, 10)])
+def test_peak_pick_matches_librosa(delta, wait):
+    librosa = pytest.importorskip("librosa")
+    envelope = np.random.default_rng(wait).random(2000)
+
+    expected = librosa.util.peak_pick(envelope, pre_max=10, post_max=10, pre_avg=20, post_avg=20, delta=delta, wait=wait)
+
+    np.testing.assert_array_equal(bd._peak_pick(envelope, 10, 10, 20, 20, delta, wait), expected)
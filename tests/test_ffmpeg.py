@@ -0,0 +1,22 @@
+from src.util.ffmpeg import CONCAT_FILE_ENTRY, CONCAT_LIST_ENTRY, escape_concat_path, format_ffmpeg_cmd
+
+
+def test_concat_entry_escapes_single_quotes():
+    entry = CONCAT_LIST_ENTRY.format(video_path=escape_concat_path("/videos/it's.mp4"), start_time=1, end_time=2)
+
+    assert entry.splitlines()[0] == "file 'file:/videos/it'\\''s.mp4'"
+    assert CONCAT_FILE_ENTRY.format(video_path=escape_concat_path("/videos/it's.mp4")) == entry.splitlines()[0] + "\n"
+
+
+def test_format_ffmpeg_cmd_splices_list_values():
+    template = ["ffmpeg", "-i", "{video_path}", "{video_encoder}", "-r", "{fps}", "{output_path}"]
+
+    cmd = format_ffmpeg_cmd(
+        template, video_path="in {1}.mp4", video_encoder=["-c:v", "libx264", "-crf", 18], fps=30, output_path="out.mp4"
+    )
+
+    assert cmd == ["ffmpeg", "-i", "in {1}.mp4", "-c:v", "libx264", "-crf", "18", "-r", "30", "out.mp4"]
+
+
+def test_format_ffmpeg_cmd_formats_placeholders_inside_args():
+    assert format_ffmpeg_cmd(["scale={width}:{height}"], width=1280, height=720) == ["scale=1280:720"]
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from src.util.util import downsample_envelope
+
+
+@pytest.mark.parametrize("length, max_points", [(1001, 100), (1000, 100), (157, 20), (21, 20)])
+def test_downsample_envelope_covers_every_sample(length, max_points):
+    times = np.arange(length) * 0.01
+    values = np.random.default_rng(length).random(length)
+    values[-1] = 2.0    # a peak in the last sample must survive
+
+    out_times, out_values = downsample_envelope(times, values, max_points)
+
+    assert len(out_values) == len(out_times) == max_points
+    assert out_times[0] == times[0]
+    assert out_values.max() == 2.0
+    assert out_values.min() == values.min()
+
+
+def test_downsample_envelope_keeps_short_envelopes():
+    times, values = np.arange(50.0), np.arange(50.0)
+
+    out_times, out_values = downsample_envelope(times, values, 100)
+
+    np.testing.assert_array_equal(out_times, times)
+    np.testing.assert_array_equal(out_values, values)
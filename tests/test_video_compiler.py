@@ -0,0 +1,19 @@
+from src.processors.video_compiler import _progress_frames, _progress_seconds
+
+# Two -progress blocks as ffmpeg prints them; only the last one describes the finished output
+PROGRESS = (
+    "frame=0\nfps=0.00\nout_time_us=N/A\nout_time=N/A\nprogress=continue\n"
+    "frame=89\nfps=0.00\nout_time_us=2966667\nout_time=00:00:02.966667\nprogress=end\n"
+)
+
+
+def test_progress_frames_takes_last_block():
+    assert _progress_frames(PROGRESS) == 89
+
+
+def test_progress_seconds_takes_last_block():
+    assert _progress_seconds(PROGRESS) == 2.966667
+
+
+def test_progress_seconds_without_output_time():
+    assert _progress_seconds("frame=0\nout_time_us=N/A\nprogress=end\n") == 0.0